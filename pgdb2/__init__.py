@@ -1,16 +1,25 @@
 import re
 import os
-import inspect
 import socket
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import psycopg2
 import sqlalchemy as sa
 from sqlalchemy import MetaData
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
 from sqlalchemy import exc as sa_exc
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import quote
 from typing import Optional, Dict, List
 from psycopg2.extras import DictCursor
+from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from psycopg2.extensions import adapt
 import sys
 import traceback
@@ -18,12 +27,72 @@ import warnings
 
 warnings.simplefilter("ignore", category=sa_exc.SAWarning)
 
+# engines are memoized per connection target so repeated database()
+# instantiations reuse an engine and its pooled connections instead of
+# paying the full connect/teardown cost every time. entries hold
+# (password, engine) so a credential rotation retires the stale engine
+_ENGINES: Dict[tuple, tuple] = {}
+
+# reflected MetaData is memoized per DSN (minus application_name) so
+# only the first database() against a given DSN pays for the full
+# pg_catalog inspection of every table
+_METADATA_CACHE: Dict[str, MetaData] = {}
+
+# hostname lookups and the DSN parser are constant for the life of
+# the process, so resolve/compile them once at import time
+_HOSTNAME = socket.gethostname()
+_BOXNAME = os.uname()[1]
+
+_PG_URL_RE = re.compile(
+    r"""
+    postgresql://
+    (?:
+        (?P<user>[^:/]*)
+        (?::(?P<password>[^@]*))?
+    @)?
+    (?:(?P<host>[^/:\?]+))?
+    (?::(?P<port>[^/\?]*))?
+    (?:/(?P<database>[^\?]*))?
+    """,
+    re.X)
+
+def _root_script():
+    '''
+    filename of the outermost frame (the running script),
+    a cheap frame-pointer walk vs inspect.stack() which
+    materializes FrameInfo for every frame
+    '''
+    f = sys._getframe(0)
+    while f.f_back is not None:
+        f = f.f_back
+    return f.f_code.co_filename
+
+
 def errorDetails():
     error = sys.exc_info()[0]
     details = traceback.format_exc()
     sys.stderr.write(f"{error}, {details}")
 
 
+def _resetOnCheckin(dbapi_conn, conn_record):
+    '''
+    pool checkin listener undoing the session state database()
+    sets per checkout (autocommit, timeouts, read-only default),
+    so engine-level consumers get a transactional connection back
+    '''
+    try:
+        if dbapi_conn.autocommit:
+            cur = dbapi_conn.cursor()
+            # discard all must run outside a transaction, so it
+            # goes first while autocommit is still on
+            cur.execute("discard all")
+            cur.close()
+            dbapi_conn.autocommit = False
+    except psycopg2.Error:
+        # connection already dead, pre-ping will cull it
+        pass
+
+
 class PrepareCursor(object):
     '''
     mix in with dbapi cursor class
@@ -31,38 +100,93 @@ class PrepareCursor(object):
     formatRe fishes out all format specifiers for a given paramstyle
     this one works with paramstyles 'qmark', 'format' or 'pyformat'
     '''
-    formatRe = re.compile('(\%s|\%\([\w\.]+\)s)', re.DOTALL)
+    formatRe = re.compile(r'(%s|%\([\w.]+\)s)')
+    # bound on cached statements, each one also lives in backend
+    # memory server-side until deallocated
+    maxPrepared = 500
 
     def __init__(self, *a, **kw):
         super(PrepareCursor, self).__init__(*a, **kw)
 
-        self.prepCache = {}
+        self.prepCache = OrderedDict()
+        self.prepCount = 0
 
     def execPrepared(self, cmd, args=None):
         '''
         execute a command using a prepared statement.
         '''
-        prepStmt = self.prepCache.get(cmd)
+        if self.prepCache is None:
+            # prepared statements disabled (e.g. pgbouncer
+            # transaction pooling, where the PREPARE and EXECUTE
+            # can land on different backends)
+            self.execute(cmd, args)
+            return
+
+        # interned keys make repeat lookups an identity compare
+        # instead of hashing the full SQL string every call
+        key = sys.intern(cmd) if isinstance(cmd, str) else cmd
+        prepStmt = self.prepCache.get(key)
         if prepStmt is None:
-            cmdId = f"ps_{len(self.prepCache) + 1}"
-            # unique name for new prepared statement
-            prepStmt = self.prepCache[cmd] = \
-                self.prepare(cmd, cmdId)
-
-        self.execute(prepStmt, args)
+            (prepCmd, execCmd) = self.cachePrepared(key)
+            # piggyback the declaration onto the first execution
+            # so a cold query costs one roundtrip instead of two.
+            # with args, execute() interpolates client-side: the
+            # prepared body has no specifiers left (they became $n)
+            # but any literal % in it (like 'x%') must be doubled,
+            # execCmd carries the real specifiers unchanged
+            if args is not None:
+                coldCmd = f"{prepCmd.replace('%', '%%')}; {execCmd}"
+            else:
+                coldCmd = f"{prepCmd}; {execCmd}"
+            try:
+                self.execute(coldCmd, args)
+            except Exception:
+                # the combined string is one implicit transaction,
+                # a failed EXECUTE rolls the PREPARE back with it,
+                # so the cache entry must not survive either
+                self.prepCache.pop(key, None)
+                raise
+        else:
+            self.prepCache.move_to_end(key)
+            self.execute(prepStmt, args)
+
+    def cachePrepared(self, key):
+        '''
+        translate and cache a new prepared statement under key,
+        deallocating the least recently used one when the cache
+        is full so server-side memory stays bounded.
+        '''
+        if len(self.prepCache) >= self.maxPrepared:
+            (oldKey, oldExecCmd) = self.prepCache.popitem(last=False)
+            name = oldExecCmd.split()[1].split('(')[0]
+            try:
+                self.execute(f"deallocate {name}")
+            except psycopg2.Error:
+                errorDetails()
+        # unique name for new prepared statement, a monotonic
+        # counter since eviction makes len() ambiguous
+        self.prepCount += 1
+        (prepCmd, execCmd) = self.prepare(key, f"ps_{self.prepCount}")
+        self.prepCache[key] = execCmd
+
+        return (prepCmd, execCmd)
 
     def prepare(self, cmd, cmdId):
         '''
         translate a sql command into its corresponding
-        prepared statement, and execute the declaration.
+        prepare and execute statements.
         '''
         specifiers = []
-
-        def replaceSpec(mo):
-            specifiers.append(mo.group())
-            return f"${len(specifiers)}"
-
-        replacedCmd = self.formatRe.sub(replaceSpec, cmd)
+        parts = []
+        last = 0
+        for i, m in enumerate(self.formatRe.finditer(cmd), 1):
+            specifiers.append(m.group())
+            parts.append(cmd[last:m.start()])
+            parts.append(f"${i}")
+            last = m.end()
+        parts.append(cmd[last:])
+
+        replacedCmd = "".join(parts)
         prepCmd = f"prepare {cmdId} as {replacedCmd}"
 
         if len(specifiers) == 0:    # no variable arguments
@@ -71,17 +195,41 @@ class PrepareCursor(object):
         else:       # set up argument slots in prep statement
             execCmd = f"execute {cmdId}({', '.join(specifiers)})"
 
-        self.execute(prepCmd)
-        self.prepCache[execCmd] = execCmd
-
-        return execCmd
+        return (prepCmd, execCmd)
 
-    def execManyPrepared(self, cmd, seq_of_parameters):
+    def execManyPrepared(self, cmd, seq_of_parameters, page_size=100):
         '''
         prepared statement version of executemany.
+        parameter sets are packed into batched EXECUTE messages
+        via execute_batch instead of one roundtrip per row.
         '''
-        for p in seq_of_parameters:
-            self.execPrepared(cmd, p)
+        if self.prepCache is None:
+            # prepared statements disabled, batch the raw command
+            execCmd = cmd
+        else:
+            key = sys.intern(cmd) if isinstance(cmd, str) else cmd
+            execCmd = self.prepCache.get(key)
+            if execCmd is None:
+                (prepCmd, execCmd) = self.cachePrepared(key)
+                try:
+                    self.execute(prepCmd)
+                except Exception:
+                    # a failed PREPARE leaves nothing server-side,
+                    # so drop the cache entry as well
+                    self.prepCache.pop(key, None)
+                    raise
+            else:
+                self.prepCache.move_to_end(key)
+
+        if hasattr(self.connection, 'pipeline'):
+            # libpq pipeline mode (psycopg 3): queue every EXECUTE
+            # without awaiting replies, ~1 roundtrip for the batch
+            with self.connection.pipeline():
+                for p in seq_of_parameters:
+                    self.execute(execCmd, p)
+        else:
+            execute_batch(
+                self, execCmd, seq_of_parameters, page_size=page_size)
 
         # Don't want to leave the value of the last execute() call
         try:
@@ -89,6 +237,14 @@ class PrepareCursor(object):
         except TypeError:   # fooks with psycopg
             pass
 
+    def execValues(self, cmd, seq_of_parameters, page_size=100):
+        '''
+        fast path for plain "insert ... values %s" commands,
+        packing all rows into multi-row VALUES statements
+        via execute_values.
+        '''
+        execute_values(self, cmd, seq_of_parameters, page_size=page_size)
+
 
 class Cursor(PrepareCursor, DictCursor):
     pass
@@ -105,28 +261,31 @@ class database(object):
             f"Password: {self.password}",
             f"Application_name: {self.appname}"])
 
-    def __init__(self, mode='rw', configFile='pgdb.json'):
+    def __init__(
+            self, mode='rw', configFile='pgdb.json',
+            pool=True, prepare=True, reflect=False):
         try:
             self.readonly = 'RO' in mode.upper()
             self.appname = '%s.%s.%s.%s' % (
-                socket.gethostname(),
+                _HOSTNAME,
                 os.getpid(),
                 os.environ.get('UNIQUE_ID', ''),
-                os.path.basename(inspect.stack()[-1][1]))
+                os.path.basename(_root_script()))
             self.adapt = adapt
             db_url = os.getenv(f"PGDB_{mode.upper()}")
             if db_url is None:
                 home = os.path.expanduser("~")
                 cfgPath = os.environ.get("PGDB_HOME", home)
-                boxName = os.uname()[1]
+                boxName = _BOXNAME
 
                 if os.path.exists(f"{cfgPath}/{configFile}.{boxName}"):
                     configFile = f"{configFile}.{boxName}"
 
-                print(f"{cfgPath}/{configFile}")
-                file = open(f"{cfgPath}/{configFile}", "rb")
-                option = json.loads(file.read())
-                file.close()
+                cfgBytes = Path(f"{cfgPath}/{configFile}").read_bytes()
+                if orjson is not None:
+                    option = orjson.loads(cfgBytes)
+                else:
+                    option = json.loads(cfgBytes)
                 self.host = option.get('host')
                 self.port = option.get('port')
                 self.database = option.get('database')
@@ -135,20 +294,7 @@ class database(object):
             else:
                 db_url = db_url.replace("postgres://", "postgresql://")
                 db_url = db_url.replace("pgsql://", "postgresql://")
-                pattern = re.compile(
-                r"""
-                    postgresql://
-                    (?:
-                        (?P<user>[^:/]*)
-                        (?::(?P<password>[^@]*))?
-                    @)?
-                    (?:(?P<host>[^/:\?]+))?
-                    (?::(?P<port>[^/\?]*))?
-                    (?:/(?P<database>[^\?]*))?
-                    """,
-                    re.X)
-
-                m = pattern.match(db_url)
+                m = _PG_URL_RE.match(db_url)
                 if m is not None:
                     db_cfg = m.groupdict()
                     self.host = db_cfg.pop("host")
@@ -157,37 +303,137 @@ class database(object):
                     self.user = db_cfg.pop("user")
                     self.password = db_cfg.pop("password")
                 
-            connString = "".join([
-                f"postgresql://{self.user}",
-                f":{self.password}@",
+            # credentials are percent-encoded so passwords containing
+            # @ : / ? can't corrupt the DSN
+            self.connKey = "".join([
+                f"postgresql://{quote(f'{self.user}', safe='')}",
+                f":{quote(f'{self.password}', safe='')}@",
                 f"{self.host}:",
                 f"{self.port}/",
-                f"{self.database}?",
-                f"application_name={self.appname}"])
+                f"{self.database}"])
+            connString = "".join([
+                f"{self.connKey}?",
+                f"application_name={quote(f'{self.appname}', safe='')}"])
             
-            db = create_engine(
-                connString,
-                poolclass=NullPool,
-                connect_args={'connect_timeout': 10})
-            self.engine = db.engine
-            self.metadata = MetaData()
-            self.metadata.reflect(self.engine)
-            self.conn = db.engine.raw_connection()
-            # the connection starts in transaction mode
-            # that needs rolled back in order
-            # to set the session in autocommit mode
-            self.conn.rollback()
-            self.conn.set_session(readonly=self.readonly, autocommit=True)
+            self._connString = connString
+            if pool:
+                engineKey = (
+                    self.user,
+                    self.host,
+                    self.port,
+                    self.database,
+                    self.readonly)
+                cached = _ENGINES.get(engineKey)
+                if cached is not None and cached[0] != self.password:
+                    # credentials rotated since the engine was built,
+                    # its baked-in connString would keep dialing with
+                    # the old password forever
+                    cached[1].dispose()
+                    cached = None
+                if cached is None:
+                    db = create_engine(
+                        connString,
+                        poolclass=QueuePool,
+                        pool_size=5,
+                        max_overflow=10,
+                        pool_pre_ping=True,
+                        pool_recycle=1800,
+                        connect_args={'connect_timeout': 10})
+                    sa.event.listen(db, 'checkin', _resetOnCheckin)
+                    _ENGINES[engineKey] = (self.password, db)
+                else:
+                    db = cached[1]
+                self._engine = db.engine
+                self.conn = db.engine.raw_connection()
+            else:
+                # pool=False connects straight through psycopg2 for
+                # setups where pgbouncer is already pooling, skipping
+                # sqlalchemy dialect/pool setup; the engine is still
+                # built lazily if metadata is ever accessed
+                self._engine = None
+                self.conn = psycopg2.connect(
+                    connString, connect_timeout=10)
+            # reflection is deferred to first metadata access, most
+            # callers only ever touch the raw conn/cursor
+            self._metadata = None
+            if reflect:
+                _ = self.metadata
+            # the autocommit attribute is a client-side libpq flag,
+            # unlike set_session it costs no server roundtrip. it
+            # must be set on the real psycopg2 connection: the pool's
+            # _ConnectionFairy proxy only delegates attribute reads,
+            # assigning through it would just stash the value on the
+            # proxy and leave autocommit off underneath
+            dbapiConn = getattr(
+                self.conn, 'dbapi_connection', self.conn)
+            try:
+                dbapiConn.autocommit = True
+            except psycopg2.ProgrammingError:
+                # a pooled connection can come back mid-transaction
+                dbapiConn.rollback()
+                dbapiConn.autocommit = True
             self.cursor = self.conn.cursor(cursor_factory=Cursor)
+            if os.environ.get('PGBOUNCER') == '1':
+                # pgbouncer transaction pooling routes PREPARE and
+                # EXECUTE to different backends, never prepare there
+                prepare = False
+            if not prepare:
+                self.cursor.prepCache = None
             self.available = True
-            self.cursor.execute("set statement_timeout='10min'")
-
-        except sa.exc.OperationalError:
+            # all session setup goes out in one execute/roundtrip;
+            # deallocate all drops any ps_N statements left behind
+            # by a previous holder of this pooled connection, whose
+            # names would otherwise collide with our fresh counter
+            readonly = 'on' if self.readonly else 'off'
+            self.cursor.execute(
+                "deallocate all; "
+                f"set default_transaction_read_only={readonly}; "
+                "set statement_timeout='10min'")
+
+        except (sa.exc.OperationalError, psycopg2.OperationalError):
             self.available = False
             self.conn = None
             self.cursor = None
-            self.engine = None
-            self.metadata = None
+            self._connString = None
+            self._engine = None
+            self._metadata = None
+
+    @property
+    def engine(self):
+        '''
+        sqlalchemy engine, built lazily for the direct psycopg2
+        connection path since most raw-sql callers never need it
+        '''
+        if self._engine is None and self._connString is not None:
+            self._engine = create_engine(
+                self._connString,
+                poolclass=NullPool,
+                connect_args={'connect_timeout': 10}).engine
+        return self._engine
+
+    @property
+    def metadata(self):
+        '''
+        reflected schema MetaData, loaded lazily on first access
+        and shared across instances via the per-DSN cache
+        '''
+        if self._metadata is None and self.engine is not None:
+            md = _METADATA_CACHE.get(self.connKey)
+            if md is None:
+                md = MetaData()
+                md.reflect(self.engine)
+                _METADATA_CACHE[self.connKey] = md
+            self._metadata = md
+        return self._metadata
+
+    def refresh_metadata(self):
+        '''
+        re-reflect the schema, replacing the cached MetaData
+        for this DSN (e.g. after a migration)
+        '''
+        self._metadata = MetaData()
+        self._metadata.reflect(self.engine)
+        _METADATA_CACHE[self.connKey] = self._metadata
 
     def autocommit(self, auto):
         if auto is False:
@@ -213,6 +459,15 @@ class database(object):
         return self.engine
 
 
+def _quoteIdent(name):
+    '''
+    double-quote a sql identifier, escaping embedded quotes,
+    so mixed-case, reserved-word or spaced names survive
+    '''
+    escaped = name.replace('"', '""')
+    return f'"{escaped}"'
+
+
 def create_upsert_method(
     meta: sa.MetaData,
     update_cols: Optional[Dict[str, str]] = None,
@@ -226,49 +481,54 @@ def create_upsert_method(
     wierd that the update_cols and skip_cols are table specific, but
     it is what it is
     """
+    skip_set = set(skip_cols)
+    # pandas calls method() once per chunk with the same table and
+    # keys, so the rendered template is memoized per (table, keys)
+    _upsert_cache: Dict[tuple, tuple] = {}
+
     def method(table, conn, keys, data_iter):
-        # select table that data is being inserted to (from pandas's context)
-        sql_table = sa.Table(table.name, meta)
-        # sqlalchemy and pandas to_sql does not like serial columns on upsert
-        # so we remove the column definition from the Table metatable object
-        # prior to upsert, this allows postgres to manage the serial
-        for col in skip_cols:
-            skip_columns = [col for col in sql_table._columns if col.name == col]
-            if len(skip_columns) > 0:
-                skip_instance = skip_columns[0]
-                sql_table._columns.remove(skip_instance)
-          
-        # list of dictionaries {col_name: value} of data to insert
-        dict_vals = [dict(zip(keys, data)) for data in data_iter]
-        # we also must remove the serial column from the array of dicts
-        rows = []
-        for row in dict_vals:
-            for col in skip_cols:
-                del row[col]
-            rows.append(row)
-
-        # create insert statement
-        insert_stmt = sa.dialects.postgresql.insert(sql_table).values(rows)
-
-        # create update statement for excluded fields on conflict
-        # skipping the serial column in skip_cols
-        update_stmt = {
-            exc_k.key: exc_k for exc_k in insert_stmt.excluded 
-            if exc_k.key not in skip_cols}
-        # update_cols is a dict representing a key/value of strings
-        # to do things like set foo = now() on the pg side of things
-        if update_cols:
-            update_stmt.update(update_cols)
-        
-        # create upsert statement. 
-        upsert_stmt = insert_stmt.on_conflict_do_update(
-            # index elements are primary keys of a table
-            index_elements=sql_table.primary_key.columns, 
-            # the SET part of an INSERT statement
-            set_=update_stmt 
-        )
-        
-        # execute upsert statement
-        conn.execute(upsert_stmt)
+        cached = _upsert_cache.get((table.name, tuple(keys)))
+        if cached is None:
+            # select table that data is being inserted to (from pandas's
+            # context), we only need it for the primary key, the serial
+            # columns in skip_cols are simply left out of the insert
+            # column list so postgres can manage them
+            sql_table = sa.Table(table.name, meta)
+            keep_idx = [i for i, k in enumerate(keys) if k not in skip_set]
+            keep_cols = [keys[i] for i in keep_idx]
+            pk_cols = [c.name for c in sql_table.primary_key.columns]
+
+            # every inserted column is refreshed from excluded on conflict
+            # update_cols is a dict representing a key/value of strings
+            # to do things like set foo = now() on the pg side of things
+            update_stmt = {
+                c: f"excluded.{_quoteIdent(c)}" for c in keep_cols}
+            if update_cols:
+                update_stmt.update(update_cols)
+
+            # identifiers are quoted like the old sqlalchemy path did,
+            # pandas frames routinely carry mixed-case or spaced names
+            sql = "".join([
+                f"insert into {_quoteIdent(table.name)} ",
+                f"({', '.join(_quoteIdent(c) for c in keep_cols)}) ",
+                "values %s on conflict ",
+                f"({', '.join(_quoteIdent(c) for c in pk_cols)}) ",
+                "do update set ",
+                ", ".join(
+                    f"{_quoteIdent(k)} = {v}"
+                    for k, v in update_stmt.items())])
+            cached = _upsert_cache[(table.name, tuple(keys))] = \
+                (sql, keep_idx)
+        (sql, keep_idx) = cached
+
+        # the rows stay positional tuples all the way down, no
+        # per-row dict is ever materialized for the serial drop
+        rows = (tuple(data[i] for i in keep_idx) for data in data_iter)
+
+        # execute_values packs the rows into multi-row VALUES
+        # statements on the raw dbapi cursor, bypassing sqlalchemy
+        # statement compilation entirely
+        with conn.connection.cursor() as cur:
+            execute_values(cur, sql, rows, page_size=1000)
 
     return method